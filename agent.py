@@ -1,21 +1,38 @@
+import atexit
+import hashlib
 import os
+import logging
+import sqlite3
+import threading
+from contextvars import ContextVar
+from functools import lru_cache
+from string import Template
+from cachetools import TTLCache
 from langchain_google_genai import ChatGoogleGenerativeAI
 from langchain_core.prompts import ChatPromptTemplate # Keep for potential future use
 from langchain_core.tools import tool
-from langchain_core.messages import SystemMessage, HumanMessage # For constructing messages
+from langchain_core.messages import SystemMessage, HumanMessage, AIMessage, ToolMessage # For constructing messages
 from langgraph.prebuilt import create_react_agent
-from langgraph.checkpoint.memory import InMemorySaver # Added for memory
+from pydantic import BaseModel, Field
+from langgraph.checkpoint.sqlite import SqliteSaver # Added for memory
 from database import query_db, get_db_schema
 from dotenv import load_dotenv
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY")
 if not GOOGLE_API_KEY:
     raise ValueError("GOOGLE_API_KEY not found. Please set it in your .env file or environment.")
 
-# Global checkpointer for storing conversation states
-checkpointer = InMemorySaver()
+# Global checkpointer for storing conversation states, persisted so memory survives restarts.
+# SqliteSaver switches the file to WAL on setup; NORMAL sync is durable enough under WAL.
+_checkpoint_conn = sqlite3.connect("agent_state.db", check_same_thread=False)
+_checkpoint_conn.execute("PRAGMA synchronous=NORMAL;")
+checkpointer = SqliteSaver(_checkpoint_conn)
+# Close explicitly at shutdown so the WAL is checkpointed and the file handle released
+atexit.register(_checkpoint_conn.close)
 
 # --- Database Query Tool (as previously defined) --- #
 @tool
@@ -26,18 +43,35 @@ def database_query_tool(query: str, db_path: str):
     Use this tool to answer questions about the data in the database.
     Example query: 'SELECT * FROM customers WHERE country = "USA"';
     """
-    print(f"Executing query: {query} on db: {db_path}")
+    logger.debug("Executing query: %s on db: %s", query, db_path)
     result = query_db(db_path, query)
     return result
 
-# System prompt template string
-SYSTEM_PROMPT_TEMPLATE = (
+# db_path of the request being served; set by get_agent_response for the shared session tool
+db_path_ctx: ContextVar[str] = ContextVar("db_path")
+
+# Argument schema for specific_database_query_tool, compiled once at import. No docstring:
+# pydantic would send it to the model as the parameters' description
+class DatabaseQueryInput(BaseModel):
+    query: str = Field(description="A valid SQLite SELECT statement.")
+
+# Tool shared by all agent instances; resolves the database from db_path_ctx
+@tool(args_schema=DatabaseQueryInput)
+def specific_database_query_tool(query: str):
+    """
+    Executes a SQL query against the database for this session and returns the result.
+    The query should be a valid SQL SELECT statement.
+    """
+    return database_query_tool.func(query=query, db_path=db_path_ctx.get())
+
+# System prompt template, parsed once; "$$" is a literal dollar sign
+SYSTEM_PROMPT_TEMPLATE = Template(
 """You are a Walmart e-commerce data specialist AI that analyzes seller performance through advertising and sales metrics. Key capabilities:
     
 **Walmart Metric Expertise**
 - **TACOS** = (Total Ad Spend / Total Net Sales) × 100 (measures advertising efficiency across all sales) [2][3]
 - **ROAS** = (Ad Sales / Ad Spend) (measures direct return from advertising) [3][4]
-- **Omnichannel ROAS** = Includes both online and in-store attributed sales (+20%\ avg. boost) [1]
+- **Omnichannel ROAS** = Includes both online and in-store attributed sales (+20% avg. boost) [1]
 - **CTR** = (Ad Clicks/Ad Impressions)
 - **Organic Conversion** = (Organic Units Sold/Organic Views)
 
@@ -56,7 +90,7 @@ SYSTEM_PROMPT_TEMPLATE = (
 - Filter using Walmart-specific columns: `Walmart Item Page Views`, `EBC Page Views`
 
 3. **Response Protocol**
-- Present key metrics first: "ROAS: 4.2 (Ad Sales $84k / Ad Spend $20k)"
+- Present key metrics first: "ROAS: 4.2 (Ad Sales $$84k / Ad Spend $$20k)"
 - Highlight Walmart-specific insights:  
   "Omnichannel ROAS increases 30% when including in-store sales [1]"
 - Use brief bullet points for multi-faceted answers
@@ -73,7 +107,7 @@ SYSTEM_PROMPT_TEMPLATE = (
 User: "Show best performing TACOS by brand"
 → JOIN ByBrands & Summary on Brand
 → Calculate: `TACOS = (SUM(Ad Spend)/SUM(Total Net Sales))*100`
-→ Return: "Brand A: 8.2% TACOS ($12k spend/$146k sales)"
+→ Return: "Brand A: 8.2% TACOS ($$12k spend/$$146k sales)"
 
 Use only the tables and columns from the database schema provided.
 
@@ -88,58 +122,65 @@ If a user asks a follow-up question try to keep printing data in the same table
 
    """
 
-    "You have access to a SQLite database containing tables from an uploaded Excel file. "
-    "When asked a question, first understand the database schema to identify relevant tables and columns. "
-    "Then, formulate a precise SQL query to retrieve the necessary information. "
-    "Use the 'database_query_tool' to execute your SQL query. "
-    "Provide the answer based on the query results in a clear and concise manner. "
-    "If the query is ambiguous or you need more information, ask clarifying questions. "
-    "Always ensure your SQL queries are valid for SQLite. "
-    "Focus on e-commerce related queries like sales, customer behavior, product performance, inventory, etc.\n" # Added newline for clarity
-    "Give data in a table format in markdown.\n"
-    "Database Schema: {db_schema}"
+    "Database Schema: ${db_schema}"
 )
 
-# Cache for initialized agent executors to avoid re-creation for the same db_path
-_agent_executors_cache = {}
+# Upper bound on cached executors; each executor holds an LLM client and compiled graph
+AGENT_CACHE_SIZE = 64
 
-def get_or_create_agent_executor(db_path: str):
+# Guards executor creation so concurrent first requests for a db_path build it only once
+_agent_executors_lock = threading.Lock()
+
+# Final answers to opening questions, so repeated ones skip the LLM and SQL round trips
+_response_cache = TTLCache(maxsize=2048, ttl=600)
+_response_cache_lock = threading.Lock()
+
+def _format_system_prompt(db_path: str):
     """
-    Retrieves a cached agent executor for the given db_path or creates a new one.
+    Formats the system prompt with the database schema.
+    Only called when an executor is built, so it's cached along with the executor.
     """
-    if db_path in _agent_executors_cache:
-        return _agent_executors_cache[db_path]
+    db_schema = get_db_schema(db_path)
+    formatted_schema = "\n".join(f"Table: {table}\nColumns: {', '.join(columns)}" for table, columns in db_schema.items())
+
+    # Format the system prompt with the dynamic schema
+    return SYSTEM_PROMPT_TEMPLATE.substitute(db_schema=formatted_schema)
 
+@lru_cache(maxsize=AGENT_CACHE_SIZE)
+def _build_agent_executor(db_path: str, db_mtime: float):
+    """
+    Builds a new agent executor for the given db_path. db_mtime is only part of the cache key.
+    """
     # LLM configuration
     llm = ChatGoogleGenerativeAI(model="gemini-2.5-pro-preview-03-25", temperature=0.5)
 
-    # Tool specifically bound to the db_path for this agent instance
-    @tool
-    def specific_database_query_tool(query: str):
-        """
-        Executes a SQL query against the database for this session and returns the result.
-        The query should be a valid SQL SELECT statement.
-        """
-        return database_query_tool.func(query=query, db_path=db_path)
-
     tools_for_agent = [specific_database_query_tool]
 
-    db_schema = get_db_schema(db_path)
-    formatted_schema = "\n".join([f"Table: {table}\nColumns: {', '.join(columns)}" for table, columns in db_schema.items()])
-    
-    # Format the system prompt with the dynamic schema
-    formatted_system_prompt = SYSTEM_PROMPT_TEMPLATE.format(db_schema=formatted_schema)
-    print(f"Formatted system prompt: {formatted_system_prompt}")  # Debugging line
+    formatted_system_prompt = _format_system_prompt(db_path)
+    logger.debug("Formatted system prompt: %s", formatted_system_prompt)
 
-    agent_executor = create_react_agent(
+    return create_react_agent(
         llm,
         tools=tools_for_agent,
         prompt=formatted_system_prompt, # Pass the formatted system prompt
         checkpointer=checkpointer # Add the checkpointer for memory
     )
-    
-    _agent_executors_cache[db_path] = agent_executor
-    return agent_executor
+
+def get_or_create_agent_executor(db_path: str):
+    """
+    Retrieves a cached agent executor for the given db_path or creates a new one.
+    Executors are cached by (db_path, mtime) in a bounded LRU cache.
+    """
+    db_mtime = os.path.getmtime(db_path)
+    with _agent_executors_lock:
+        return _build_agent_executor(db_path, db_mtime)
+
+def _response_cache_key(db_path: str, user_query: str):
+    """
+    Returns the response cache key for a query, tied to the current version of the database.
+    """
+    key_source = f"{db_path}|{os.path.getmtime(db_path)}|{user_query.strip().lower()}"
+    return hashlib.blake2b(key_source.encode()).hexdigest()
 
 def get_agent_response(db_path: str, user_query: str, thread_id: str): # Added thread_id
     """
@@ -147,23 +188,53 @@ def get_agent_response(db_path: str, user_query: str, thread_id: str): # Added t
     """
     agent_executor = get_or_create_agent_executor(db_path)
 
+    # Point the shared query tool at this request's database
+    db_path_ctx.set(db_path)
+
     # Configuration for invoking the agent with a specific thread_id for memory
     config = {"configurable": {"thread_id": thread_id}}
 
+    # An opening question can't depend on earlier turns, so identical ones on the
+    # same database can be answered from the response cache
+    cache_key = None
+    if checkpointer.get_tuple(config) is None:
+        cache_key = _response_cache_key(db_path, user_query)
+        with _response_cache_lock:
+            cached_response = _response_cache.get(cache_key)
+        if cached_response is not None:
+            # Record the turn so follow-up questions still see it in memory
+            agent_executor.update_state(
+                config,
+                {"messages": [HumanMessage(content=user_query), AIMessage(content=cached_response)]},
+                as_node="agent",
+            )
+            yield cached_response
+            return
+
     # Invoke the agent. The input is a list of messages.
     for token, metadata in agent_executor.stream(
         {"messages": [HumanMessage(content=user_query)]}, # Use HumanMessage
         config,
         stream_mode = "messages",
+        checkpoint_during = False, # Persist the turn once at the end instead of after every step
     ):
-    
-    # The agent's response is the last message in the list of messages
-        if metadata["langgraph_node"] == "agent":
-                    yield token.content
-        elif metadata["langgraph_node"] == "tools":
-                yield "Querying database"
-
-    # return "Sorry, I couldn't get a valid response from the agent."
+        # Agent tokens arrive as AIMessageChunks, tool results as ToolMessages
+        if isinstance(token, AIMessage):
+            yield token.content
+        elif isinstance(token, ToolMessage):
+            yield "Querying database"
+
+    if cache_key is not None:
+        final_message = agent_executor.get_state(config).values["messages"][-1]
+        # Only cache a finished text answer; an empty reply or a pending tool call would be replayed as is
+        if (
+            isinstance(final_message, AIMessage)
+            and isinstance(final_message.content, str)
+            and final_message.content.strip()
+            and not final_message.tool_calls
+        ):
+            with _response_cache_lock:
+                _response_cache[cache_key] = final_message.content
 
 # (Keep the __main__ block commented out or remove if not needed for direct testing of this file)
 # if __name__ == '__main__':
@@ -1,10 +1,31 @@
 import streamlit as st
-import pandas as pd
-from database import create_db_from_excel, query_db
-from agent import get_agent_response
 import os
+import io
+import hashlib
 import uuid  # Added for generating unique thread IDs
 
+# Databases built from uploads are stored here, named by a hash of the file contents
+DB_CACHE_DIR = "cache"
+
+@st.cache_resource(show_spinner=False)
+def build_db_for_upload(file_hash, _file_bytes):
+    """
+    Builds the SQLite database for an uploaded Excel file, once per distinct file contents.
+    Shared across sessions; a file that was seen before reuses the database on disk.
+    """
+    from database import create_db_from_excel  # Loaded lazily along with the rest of the upload path
+
+    db_path = os.path.join(DB_CACHE_DIR, f"{file_hash}.sqlite")
+    if os.path.exists(db_path):
+        return db_path
+
+    os.makedirs(DB_CACHE_DIR, exist_ok=True)
+    # Parse the upload straight from memory; build under a temporary name so an
+    # interrupted import is never reused
+    create_db_from_excel(io.BytesIO(_file_bytes), f"{db_path}.tmp")
+    os.replace(f"{db_path}.tmp", db_path)
+    return db_path
+
 # Title for the app
 st.title("SQL AI Agent for E-commerce Data")
 
@@ -16,15 +37,15 @@ if 'file_uploaded' not in st.session_state:
     st.session_state.file_uploaded = False
 
 if uploaded_file is not None:
-    # Save the uploaded file temporarily
-    with open("temp_excel.xlsx", "wb") as f:
-        f.write(uploaded_file.getbuffer())
+    # Imported here so the upload prompt renders without loading the LangChain agent stack
+    from agent import get_agent_response
 
-    db_path = "temp_db.sqlite"
+    # Key the database by the file contents so reruns and re-uploads skip the import
+    file_hash = hashlib.blake2b(uploaded_file.getbuffer(), digest_size=16).hexdigest()
 
     try:
+        db_path = build_db_for_upload(file_hash, uploaded_file.getbuffer())
         if st.session_state.file_uploaded == False:
-            create_db_from_excel("temp_excel.xlsx", db_path)
             st.success(f"Database created successfully at {db_path}!")
             st.session_state.file_uploaded = True
 
@@ -55,12 +76,6 @@ if uploaded_file is not None:
 
             # Get agent response
             try:
-                # Ensure thread_id is available (it should be set above)
-                if "thread_id" not in st.session_state:
-                    # Fallback, though ideally it's always set when db is ready
-                    st.session_state.thread_id = str(uuid.uuid4())
-                    print(f"Fallback: Initialized new thread_id in chat input: {st.session_state.thread_id}")
-
                 # Display assistant response in chat message container
                 with st.chat_message("assistant"):
                     response = st.write_stream(get_agent_response(db_path, prompt, st.session_state.thread_id))
@@ -71,12 +86,6 @@ if uploaded_file is not None:
 
     except Exception as e:
         st.error(f"Error processing Excel file: {e}")
-    finally:
-        # Clean up temporary files
-        if os.path.exists("temp_excel.xlsx"):
-            os.remove("temp_excel.xlsx")
-        # if os.path.exists(db_path): # Keep the DB for the session or remove if not needed
-        #     os.remove(db_path)
 else:
     st.info("Please upload an Excel file to begin.")
     
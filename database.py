@@ -1,116 +1,192 @@
 import pandas as pd
-from sqlalchemy import create_engine, text
+from sqlalchemy import create_engine, event, text
 import os
+import sqlite3
 import numpy as np
 import re
+import threading
+from collections import OrderedDict
+from functools import lru_cache
+
+# Positions of the report sheets that are imported; the rest of the workbook is ignored
+SHEETS_TO_IMPORT = {0, 2, 5, 8}
+
+# Column name cleanup for SQL compatibility: parentheses are dropped, other separators become '_'
+COLUMN_NAME_TRANSLATION = str.maketrans({' ': '_', '(': None, ')': None, '.': '_', '-': '_', '/': '_', '\\': '_'})
+
+# Anything that isn't alphanumeric or '_', stripped from table names
+NON_WORD_CHARS = re.compile(r'\W')
+
+# Captures the display text of an =HYPERLINK("url", "text") formula
+HYPERLINK_PATTERN = re.compile(r'=HYPERLINK\s*\(\s*"[^"]*"\s*,\s*"([^"]*)"\s*\)')
+
+# Upper bound on cached query engines; the least recently used one is disposed past it
+QUERY_ENGINE_CACHE_SIZE = 8
+
+# Query engines by db_path, least recently used first
+_query_engines = OrderedDict()
+_query_engines_lock = threading.Lock()
 
 def create_db_from_excel(excel_path, db_path):
     """
     Reads an Excel file and creates a SQLite database from its sheets.
     Each sheet is converted into a separate table with proper header handling.
+    excel_path may also be a file-like object, e.g. an in-memory upload.
     """
     if os.path.exists(db_path):
         os.remove(db_path)  # Remove existing DB to start fresh
+    # Close pooled query connections to db_path; any still open read the removed file, not the new one
+    _dispose_query_engine(db_path)
         
-    xls = pd.ExcelFile(excel_path)
-    engine = create_engine(f"sqlite:///{db_path}")
+    with pd.ExcelFile(excel_path, engine="calamine") as xls:
+        # Bulk-load through one raw sqlite3 connection so pandas inserts rows with executemany
+        # instead of going through SQLAlchemy; the file is freshly created, so skip journaling and fsyncs
+        connection = sqlite3.connect(db_path)
+        connection.execute("PRAGMA journal_mode=MEMORY;")
+        connection.execute("PRAGMA synchronous=OFF;")
+        connection.execute("PRAGMA temp_store=MEMORY;")
     
-    # Process each sheet in the Excel file
-    for sheet_idx, sheet_name in enumerate(xls.sheet_names):
-        try:
-            # First, read the Excel sheet without setting headers
-            if sheet_idx == 0:  # First table (summary table)
-                # For the first table, use the first row as header
-                df = pd.read_excel(xls, sheet_name=sheet_name)
-                print(f"Processing summary table '{sheet_name}' with standard headers")
-
-            elif sheet_idx == 2:
-                # remove the top two rows and set the third row as header
-                df = pd.read_excel(xls, sheet_name=sheet_name, header=2)
-
-                # convert the first two columns to string
-                df.iloc[:, 0:2] = df.iloc[:, 0:2].astype(str)
-
-                hyperlink_pattern = r'=HYPERLINK\s*\(\s*"[^"]*"\s*,\s*"([^"]*)"\s*\)'
-            
-                # Get the first two column names
-                first_two_cols = list(df.columns)[:2] if len(df.columns) >= 2 else list(df.columns)
+        # Process each sheet in the Excel file
+        for sheet_idx, sheet_name in enumerate(xls.sheet_names):
+            if sheet_idx not in SHEETS_TO_IMPORT:
+                continue  # Skip unused sheets before anything is parsed
+
+            try:
+                # First, read the Excel sheet without setting headers
+                if sheet_idx == 0:  # First table (summary table)
+                    # For the first table, use the first row as header
+                    df = pd.read_excel(xls, sheet_name=sheet_name)
+                    print(f"Processing summary table '{sheet_name}' with standard headers")
+
+                elif sheet_idx == 2:
+                    # remove the top two rows and set the third row as header
+                    df = pd.read_excel(xls, sheet_name=sheet_name, header=2)
+
+                    # Get the first two column names
+                    first_two_cols = list(df.columns)[:2] if len(df.columns) >= 2 else list(df.columns)
+
+                    # convert the first two columns to string, replacing the columns rather than
+                    # writing strings into their inferred (possibly float) dtype
+                    df[first_two_cols] = df[first_two_cols].astype(str)
                 
-                for col in first_two_cols:
-                    # Apply the extraction to each cell in the column
-                    df[col] = df[col].apply(lambda x: 
-                                        re.search(hyperlink_pattern, str(x)).group(1) 
-                                        if isinstance(x, str) and re.search(hyperlink_pattern, str(x)) 
-                                        else x)
-                print(f"Processing table '{sheet_name}' with standard headers")
-                # display(df.head())  # Display the first few rows of the DataFrame
-
-                # parse the first two columns as strings, split by comma
-
-            elif sheet_idx == 5:  # Second table (summary table)
-                # For the second table, use the first row as header
-                df = pd.read_excel(xls, sheet_name=sheet_name)
-
-                print(f"Processing summary table '{sheet_name}' with standard headers")
-
-            elif sheet_idx == 8:  # Second table (detailed table)
-                # For other tables, we need to handle the multi-row headers
-                # Read the sheet with header=None to get all rows
-                df = pd.read_excel(xls, sheet_name=sheet_name, header=None)
+                    for col in first_two_cols:
+                        # Extract the link text column-wise; cells without a HYPERLINK formula are kept
+                        extracted = df[col].str.extract(HYPERLINK_PATTERN, expand=False)
+                        df[col] = extracted.fillna(df[col])
+                    print(f"Processing table '{sheet_name}' with standard headers")
+                    # display(df.head())  # Display the first few rows of the DataFrame
+
+                    # parse the first two columns as strings, split by comma
+
+                elif sheet_idx == 5:  # Second table (summary table)
+                    # For the second table, use the first row as header
+                    df = pd.read_excel(xls, sheet_name=sheet_name)
+
+                    print(f"Processing summary table '{sheet_name}' with standard headers")
+
+                elif sheet_idx == 8:  # Second table (detailed table)
+                    # For other tables, we need to handle the multi-row headers
+                    # Read the sheet with header=None to get all rows
+                    df = pd.read_excel(xls, sheet_name=sheet_name, header=None)
                 
-                if len(df) >= 3:  # Make sure we have enough rows
-                    # Get the header rows
-                    top_row = df.iloc[0].replace({np.nan: None, 'NaN': None})  # Row with potential suffixes
-                    third_row = df.iloc[2].replace({np.nan: None, 'NaN': None})  # Row with base column names
+                    if len(df) >= 3:  # Make sure we have enough rows
+                        # Get the header rows, treating literal 'NaN' cells as empty
+                        top_row = df.iloc[0].mask(df.iloc[0] == 'NaN')  # Row with potential suffixes
+                        third_row = df.iloc[2].mask(df.iloc[2] == 'NaN')  # Row with base column names
+                    
+                        # Each suffix applies to its column and every column after it up to the next suffix
+                        suffixes = top_row.map(str, na_action='ignore').ffill()
                     
-                    # Create combined headers
-                    combined_headers = []
-                    current_suffix = None
+                        # Get base column names from third row, falling back to the column position
+                        base_names = third_row.astype(str).where(third_row.notna(), [f"col_{i}" for i in range(len(third_row))])
                     
-                    for i in range(len(top_row)):
-                        # Update suffix if we encounter a non-None value in the top row
-                        if top_row[i] is not None:
-                            current_suffix = str(top_row[i])
-                        
-                        # Get base column name from third row
-                        base_name = str(third_row[i]) if third_row[i] is not None else f"col_{i}"
-                        
-                        # Create combined column name
-                        if current_suffix:
-                            combined_headers.append(f"{base_name}_{current_suffix}")
-                        else:
-                            combined_headers.append(base_name)
+                        # Create combined column names column-wise
+                        has_suffix = suffixes.notna() & (suffixes != '')
+                        combined_headers = np.where(has_suffix, base_names + '_' + suffixes, base_names)
                     
-                    # Set combined headers and drop the first three rows
-                    df.columns = combined_headers
-                    df = df.iloc[3:]
-                    print(f"Processed table '{sheet_name}' with combined headers")
+                        # Set combined headers and drop the first three rows; the text header rows forced
+                        # every column to object dtype, so re-infer the data rows' types in the same pass
+                        df.columns = combined_headers
+                        df = df.iloc[3:].infer_objects()
+                        print(f"Processed table '{sheet_name}' with combined headers")
                     
-                else:
-                    print(f"Sheet '{sheet_name}' doesn't have enough rows for header processing")
-            else:  # For other tables, use the first row as header
-                continue
+                    else:
+                        print(f"Sheet '{sheet_name}' doesn't have enough rows for header processing")
             
-            # Reset index to ensure proper SQLite import
-            df = df.reset_index(drop=True)
+                # Reset index to ensure proper SQLite import
+                df = df.reset_index(drop=True)
             
-            # Clean column names for SQL compatibility
-            df.columns = [str(col).replace(' ', '_').replace('(', '').replace(')', '').replace('.', '_')
-                         .replace('-', '_').replace('/', '_').replace('\\', '_') for col in df.columns]
+                # Clean column names for SQL compatibility
+                df.columns = [str(col).translate(COLUMN_NAME_TRANSLATION) for col in df.columns]
             
-            # Sanitize table name
-            table_name = ''.join(e for e in sheet_name if e.isalnum() or e == '_')
-            if not table_name:  # if sheet name was all special chars
-                table_name = f"table_{sheet_idx}"
+                # Sanitize table name
+                table_name = NON_WORD_CHARS.sub('', sheet_name)
+                if not table_name:  # if sheet name was all special chars
+                    table_name = f"table_{sheet_idx}"
 
-            # display(df)  # Display the first few rows of the DataFrame
+                # display(df)  # Display the first few rows of the DataFrame
 
-            df.to_sql(table_name, engine, index=False, if_exists='replace')
-            print(f"Sheet '{sheet_name}' imported as table '{table_name}' with {len(df)} rows.")
+                df.to_sql(table_name, connection, index=False, if_exists='replace')
+                print(f"Sheet '{sheet_name}' imported as table '{table_name}' with {len(df)} rows.")
             
-        except Exception as e:
-            print(f"Could not import sheet '{sheet_name}': {e}")
+            except Exception as e:
+                print(f"Could not import sheet '{sheet_name}': {e}")
     
+    connection.close()
+    return create_engine(f"sqlite:///{db_path}")
+
+def deny_attach(action, arg1, arg2, db_name, trigger_name):
+    """
+    sqlite3 authorizer for query connections that rejects ATTACH statements.
+    """
+    return sqlite3.SQLITE_DENY if action == sqlite3.SQLITE_ATTACH else sqlite3.SQLITE_OK
+
+def get_query_engine(db_path):
+    """
+    Returns the shared engine for querying the database at db_path.
+    Its connection pool is reused across calls; connections are read-only.
+    """
+    with _query_engines_lock:
+        engine = _query_engines.get(db_path)
+        if engine is not None:
+            _query_engines.move_to_end(db_path)
+            return engine
+
+        engine = _create_query_engine(db_path)
+        _query_engines[db_path] = engine
+        if len(_query_engines) > QUERY_ENGINE_CACHE_SIZE:
+            _, evicted = _query_engines.popitem(last=False)
+            evicted.dispose()  # Close its pooled connections instead of leaving them to garbage collection
+        return engine
+
+def _dispose_query_engine(db_path):
+    """
+    Drops the cached engine for db_path, if there is one, and closes its pooled connections.
+    """
+    with _query_engines_lock:
+        engine = _query_engines.pop(db_path, None)
+    if engine is not None:
+        engine.dispose()
+
+def _create_query_engine(db_path):
+    """
+    Creates the engine for querying the database at db_path.
+    """
+    # Open the file read-only so agent-generated SQL can't modify it; unlike PRAGMA query_only,
+    # the SQL run on the connection can't switch this off
+    engine = create_engine(
+        f"sqlite:///{db_path}",
+        creator=lambda: sqlite3.connect(f"file:{db_path}?mode=ro", uri=True, check_same_thread=False),
+    )
+
+    @event.listens_for(engine, "connect")
+    def set_query_pragmas(dbapi_connection, connection_record):
+        # ATTACH would open other files, e.g. other uploads' databases, read-write
+        dbapi_connection.set_authorizer(deny_attach)
+        cursor = dbapi_connection.cursor()
+        cursor.execute("PRAGMA cache_size=-65536;")  # 64 MiB page cache
+        cursor.close()
+
     return engine
 
 def query_db(db_path, query_string):
@@ -118,37 +194,38 @@ def query_db(db_path, query_string):
     Connects to the SQLite database and executes a given SQL query.
     Returns the query result.
     """
-    engine = create_engine(f"sqlite:///{db_path}")
-    with engine.connect() as connection:
-        try:
-            result = connection.execute(text(query_string))
-            rows = result.fetchall()
-            # Get column names for better display if needed
-            # column_names = result.keys()
-            # return [dict(zip(column_names, row)) for row in rows] # Returns list of dicts
-            return rows # Returns list of tuples
-        except Exception as e:
-            return f"Error executing query: {e}"
+    # Run on the pooled sqlite3 connection directly so rows come back as plain tuples
+    # instead of SQLAlchemy Row objects; the pool's connections are read-only
+    connection = get_query_engine(db_path).raw_connection()
+    try:
+        cursor = connection.cursor()
+        return cursor.execute(query_string).fetchall() # Returns list of tuples
+    except Exception as e:
+        return f"Error executing query: {e}"
+    finally:
+        connection.close()  # Returns the connection to the pool
 
 def get_db_schema(db_path):
     """
     Returns the schema of the database (table names and their columns).
+    Cached by (db_path, mtime) so a rebuilt database is read again.
+    """
+    return _read_db_schema(db_path, os.path.getmtime(db_path))
+
+@lru_cache(maxsize=16)
+def _read_db_schema(db_path, db_mtime):
+    """
+    Reads the schema of the database at db_path. db_mtime is only part of the cache key.
     """
-    engine = create_engine(f"sqlite:///{db_path}")
+    engine = get_query_engine(db_path)
     schema = {}
     with engine.connect() as connection:
-        # Get table names
-        table_names_query = text("SELECT name FROM sqlite_master WHERE type='table';")
-        tables_result = connection.execute(table_names_query)
-        table_names = [row[0] for row in tables_result.fetchall()]
-
-        for table_name in table_names:
-            # Get column info for each table
-            columns_query = text(f"PRAGMA table_info({table_name});")
-            columns_result = connection.execute(columns_query)
-            columns = []
-            for col_info in columns_result.fetchall():
-                # col_info format: (cid, name, type, notnull, dflt_value, pk)
-                columns.append(f"{col_info[1]} ({col_info[2]})")
-            schema[table_name] = columns
+        # Get every table's column info in one query instead of a PRAGMA per table
+        columns_query = text(
+            "SELECT m.name, p.name, p.type FROM sqlite_master m "
+            "JOIN pragma_table_info(m.name) p "
+            "WHERE m.type='table' ORDER BY m.rowid, p.cid;"
+        )
+        for table_name, column_name, column_type in connection.execute(columns_query).fetchall():
+            schema.setdefault(table_name, []).append(f"{column_name} ({column_type})")
     return schema